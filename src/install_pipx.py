@@ -1,14 +1,15 @@
 from __future__ import annotations
 
-import argparse
-import json
 import logging
-import logging.config
 import os
 import os.path
-import subprocess
-import venv
+import sys
 from pathlib import Path
+from typing import TYPE_CHECKING
+
+if TYPE_CHECKING:
+    import argparse
+    import subprocess
 
 logger = logging.getLogger("pipx-installer")
 
@@ -30,90 +31,105 @@ ENV_DIR_HELP = (
 )
 
 DEFAULT_PIPX_BIN_DIR = Path.home() / ".local/bin"
-LOCAL_BIN_DIR = Path(os.environ.get("PIPX_BIN_DIR", DEFAULT_PIPX_BIN_DIR)).resolve()
 CORE_VENV_DEPS = ("pip", "setuptools")
+MIN_PIP_VERSION_FOR_PYTHON_OPTION = (22, 3)
 
-parser = argparse.ArgumentParser(
-    prog="install-pipx",
-    description="Creates virtual Python environments and installs pipx into it. "
-    "The default location is chosen according to the XDG Base Directory Specification.",
-    epilog="After installing pipx with this script,"
-    " the pipx command should be available from anywhere without activating any environment.",
-)
-parser.add_argument(
-    "env_dir",
-    nargs="?",
-    default=DEFAULT_ENV_DIR,
-    metavar="ENV_DIR",
-    help=ENV_DIR_HELP,
-)
 
-arg_group_venv = parser.add_argument_group("Options for environment creation")
-arg_group_venv.add_argument(
-    "--system-site-packages",
-    default=False,
-    action="store_true",
-    help="Give the virtual environment access to the system site-packages dir.",
-)
-mutex_group_symlinks = arg_group_venv.add_mutually_exclusive_group()
-mutex_group_symlinks.add_argument(
-    "--symlinks",
-    default=DEFAULT_USE_SYMLINKS,
-    action="store_true",
-    dest="symlinks",
-    help=SYMLINKS_HELP,
-)
-mutex_group_symlinks.add_argument(
-    "--copies",
-    default=not DEFAULT_USE_SYMLINKS,
-    action="store_false",
-    dest="symlinks",
-    help=COPIES_HELP,
-)
-arg_group_venv.add_argument(
-    "--clear",
-    default=False,
-    action="store_true",
-    dest="clear",
-    help="Delete the contents of the environment directory if it already exists, before environment creation.",
-)
-arg_group_venv.add_argument(
-    "--prompt", help="Provides an alternative prompt prefix for this environment."
-)
-arg_group_venv.add_argument(
-    "--upgrade-deps",
-    default=False,
-    action="store_true",
-    dest="upgrade_deps",
-    help="Before installing pipx, upgrade core dependencies "
-    f"(i.e. {', '.join(CORE_VENV_DEPS)}) to their latest versions.",
-)
+def build_parser() -> argparse.ArgumentParser:
+    import argparse
 
-arg_group_pipx = parser.add_argument_group("Options related to pipx")
-arg_group_pipx.add_argument(
-    "--no-ensure-path",
-    action="store_false",
-    dest="ensure_path",
-    help="Skip both calling pipx ensurepath and creating a symlink after installation. "
-    "When using this option, the pipx command will not be globally available.",
-)
+    parser = argparse.ArgumentParser(
+        prog="install-pipx",
+        description="Creates virtual Python environments and installs pipx into it. "
+        "The default location is chosen according to the XDG Base Directory Specification.",
+        epilog="After installing pipx with this script,"
+        " the pipx command should be available from anywhere without activating any environment.",
+    )
+    parser.add_argument(
+        "env_dir",
+        nargs="?",
+        default=DEFAULT_ENV_DIR,
+        metavar="ENV_DIR",
+        help=ENV_DIR_HELP,
+    )
 
-parser.add_argument(
-    "--dry-run",
-    action="store_true",
-    help="Perform a dry run, i.e. do not write anything to disk.",
-)
-mutex_group_logging = parser.add_mutually_exclusive_group()
-mutex_group_logging.add_argument(
-    "--log-config",
-    help="Path to a JSON or INI file containing advanced logging configuration.",
-)
-mutex_group_logging.add_argument(
-    "-v", "--verbose", action="count", default=0, help="Increase logging level."
-)
-mutex_group_logging.add_argument(
-    "-q", "--quiet", action="count", default=0, help="Decrease logging level."
-)
+    arg_group_venv = parser.add_argument_group("Options for environment creation")
+    arg_group_venv.add_argument(
+        "--system-site-packages",
+        default=False,
+        action="store_true",
+        help="Give the virtual environment access to the system site-packages dir.",
+    )
+    mutex_group_symlinks = arg_group_venv.add_mutually_exclusive_group()
+    mutex_group_symlinks.add_argument(
+        "--symlinks",
+        default=DEFAULT_USE_SYMLINKS,
+        action="store_true",
+        dest="symlinks",
+        help=SYMLINKS_HELP,
+    )
+    mutex_group_symlinks.add_argument(
+        "--copies",
+        default=not DEFAULT_USE_SYMLINKS,
+        action="store_false",
+        dest="symlinks",
+        help=COPIES_HELP,
+    )
+    arg_group_venv.add_argument(
+        "--clear",
+        default=False,
+        action="store_true",
+        dest="clear",
+        help="Delete the contents of the environment directory if it already exists, before environment creation.",
+    )
+    arg_group_venv.add_argument(
+        "--prompt", help="Provides an alternative prompt prefix for this environment."
+    )
+    arg_group_venv.add_argument(
+        "--without-pip",
+        default=True,
+        action="store_false",
+        dest="with_pip",
+        help="Skip bootstrapping pip in the environment. "
+        "Instead, pipx is installed by the pip of the Python interpreter running this script "
+        "(requires pip 22.3 or later).",
+    )
+    arg_group_venv.add_argument(
+        "--upgrade-deps",
+        default=False,
+        action="store_true",
+        dest="upgrade_deps",
+        help="Before installing pipx, upgrade core dependencies "
+        f"(i.e. {', '.join(CORE_VENV_DEPS)}) to their latest versions.",
+    )
+
+    arg_group_pipx = parser.add_argument_group("Options related to pipx")
+    arg_group_pipx.add_argument(
+        "--no-ensure-path",
+        action="store_false",
+        dest="ensure_path",
+        help="Skip both calling pipx ensurepath and creating a symlink after installation. "
+        "When using this option, the pipx command will not be globally available.",
+    )
+
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Perform a dry run, i.e. do not write anything to disk.",
+    )
+    mutex_group_logging = parser.add_mutually_exclusive_group()
+    mutex_group_logging.add_argument(
+        "--log-config",
+        help="Path to a JSON or INI file containing advanced logging configuration.",
+    )
+    mutex_group_logging.add_argument(
+        "-v", "--verbose", action="count", default=0, help="Increase logging level."
+    )
+    mutex_group_logging.add_argument(
+        "-q", "--quiet", action="count", default=0, help="Decrease logging level."
+    )
+
+    return parser
 
 
 def cli(
@@ -123,6 +139,7 @@ def cli(
     clear: bool,
     symlinks: bool,
     prompt: str | None,
+    with_pip: bool,
     upgrade_deps: bool,
     ensure_path: bool,
     dry_run: bool,
@@ -138,68 +155,236 @@ def cli(
 
     normalized_env_dir = Path(env_dir).expanduser().resolve()
 
+    if not with_pip:
+        # Fail before the environment is created without pip, not afterwards.
+        check_host_pip()
+
     logger.info("creating Python environment in %s", normalized_env_dir)
     if not dry_run:
+        # venv is only imported when it is actually needed,
+        # the same goes for the other rather expensive imports further below.
+        import venv
+
         # EnvBuilder.create creates the environment directory
         # and all necessary subdirectories that don't already exist
         venv.EnvBuilder(
             system_site_packages=system_site_packages,
             clear=clear,
             symlinks=symlinks,
-            with_pip=True,
+            with_pip=with_pip,
             prompt=prompt,
         ).create(normalized_env_dir)
 
-    pip = os.fspath(normalized_env_dir / "bin/pip")
+    # The executables are only handed to subprocess, so plain strings suffice.
+    bin_dir = f"{normalized_env_dir}{os.sep}bin{os.sep}"
+    if with_pip:
+        pip = [bin_dir + "pip"]
+    else:
+        # Without ensurepip, there is no pip in the environment yet.
+        # But our own pip can install into the environment via its --python option.
+        pip = [sys.executable, "-m", "pip", "--python", bin_dir + "python"]
 
     # Starting with Python 3.9, EnvBuilder has an upgrade_deps parameter.
     # But because we want to support Python 3.8 as well, we need to implement it ourselves.
+    # Upgrading the core dependencies is done in the same pip call that installs pipx,
+    # so that we only pay for starting pip (and resolving dependencies) once.
     if upgrade_deps:
-        logger.info("upgrading core dependencies: %s", ", ".join(CORE_VENV_DEPS))
-        if not dry_run:
-            subprocess.run([pip, "install", "--upgrade", *CORE_VENV_DEPS], check=True)  # noqa: S603
-
-    logger.info("installing pipx")
+        logger.info(
+            "upgrading core dependencies (%s) and installing pipx",
+            ", ".join(CORE_VENV_DEPS),
+        )
+        pip_args = [*pip, "install", "--upgrade", *CORE_VENV_DEPS, "pipx"]
+    else:
+        logger.info("installing pipx")
+        pip_args = [*pip, "install", "pipx"]
     if not dry_run:
-        subprocess.run([pip, "install", "pipx"], check=True)  # noqa: S603
+        # Skip pip's check for a newer version of itself (an extra HTTPS request)
+        # and never wait for user input. Settings from the environment take precedence.
+        pip_env = {
+            "PIP_DISABLE_PIP_VERSION_CHECK": "1",
+            "PIP_NO_INPUT": "1",
+            **os.environ,
+        }
+        run_command(pip_args, name="pip", env=pip_env)
 
-    pipx = os.fspath(normalized_env_dir / "bin/pipx")
+    pipx = bin_dir + "pipx"
 
     if ensure_path:
-        pipx_symlink = LOCAL_BIN_DIR / "pipx"
+        # The bin dir is only resolved here, so that importing this module
+        # or skipping ensurepath does not touch the file system.
+        local_bin_dir = Path(
+            os.environ.get("PIPX_BIN_DIR", DEFAULT_PIPX_BIN_DIR)
+        ).resolve()
+        pipx_symlink = local_bin_dir / "pipx"
 
         logger.info("calling pipx ensurepath")
         if not dry_run:
-            subprocess.run([pipx, "ensurepath"], check=True)  # noqa: S603
+            run_command([pipx, "ensurepath"], name="pipx")
 
-        logger.info("creating symlink to pipx in %s", LOCAL_BIN_DIR)
+        logger.info("creating symlink to pipx in %s", local_bin_dir)
         if not dry_run:
+            # pipx ensurepath only adds the bin dir to PATH, it might not exist yet
+            local_bin_dir.mkdir(parents=True, exist_ok=True)
             pipx_symlink.symlink_to(pipx)
 
 
+def check_host_pip():
+    """Exit unless the pip of the running interpreter supports its --python option."""
+    import importlib.util
+    import re
+
+    if importlib.util.find_spec("pip") is None:
+        sys.exit(
+            f"error: --without-pip requires pip to be installed for {sys.executable}"
+        )
+
+    import pip
+
+    match = re.match(r"(\d+)\.(\d+)", pip.__version__)
+    if match and tuple(map(int, match.groups())) < MIN_PIP_VERSION_FOR_PYTHON_OPTION:
+        sys.exit(
+            "error: --without-pip requires pip "
+            f"{'.'.join(map(str, MIN_PIP_VERSION_FOR_PYTHON_OPTION))} or later "
+            f"for {sys.executable}, but pip {pip.__version__} is installed"
+        )
+
+
+def run_command(args: list[str], *, name: str, env: dict[str, str] | None = None):
+    """Run a command and pipe its output to the child logger of the given name."""
+    import subprocess
+
+    command_logger = logger.getChild(name)
+
+    # On Python 3.8 and 3.9, subprocess only launches the child via posix_spawn
+    # instead of fork/exec if close_fds=False (and cwd, preexec_fn, etc. are unset).
+    # There, we deliberately pass inheritable file descriptors through to the child.
+    # Starting with Python 3.10, subprocess uses vfork even with close_fds=True.
+    with subprocess.Popen(  # noqa: S603
+        args,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        close_fds=sys.version_info >= (3, 10),
+        env=env,
+    ) as process:
+        # Just like subprocess.run, make sure the child does not outlive an error.
+        try:
+            # On Linux 5.3+ (and Python 3.9+), a pidfd lets us wait for the output
+            # and for the termination of the process in the same call to select.
+            try:
+                pidfd = os.pidfd_open(process.pid)
+            except (AttributeError, OSError):
+                pidfd = None
+            try:
+                stderr_lines = _pipe_output_to_logger(process, pidfd, command_logger)
+            finally:
+                if pidfd is not None:
+                    os.close(pidfd)
+        except BaseException:
+            process.kill()
+            process.wait()
+            raise
+        returncode = process.wait()
+
+    if returncode:
+        # The reason for the failure must not get lost, even if warnings are not logged.
+        if not command_logger.isEnabledFor(logging.WARNING):
+            for line in stderr_lines:
+                command_logger.error("%s", line)
+        raise subprocess.CalledProcessError(
+            returncode, args, stderr="\n".join(stderr_lines)
+        )
+
+
+def _pipe_output_to_logger(
+    process: subprocess.Popen, pidfd: int | None, command_logger: logging.Logger
+) -> list[str]:
+    """Log the output of the process and return the lines it wrote to stderr."""
+    import selectors
+
+    # The selector picks the most efficient mechanism available (epoll, kqueue, ...).
+    # The data attached to each pipe is the level its lines are logged with
+    # and the list the logged lines are collected in (only needed for stderr).
+    stderr_lines = []
+    selector = selectors.DefaultSelector()
+    selector.register(process.stdout, selectors.EVENT_READ, (logging.INFO, None))
+    selector.register(
+        process.stderr, selectors.EVENT_READ, (logging.WARNING, stderr_lines)
+    )
+    if pidfd is not None:
+        selector.register(pidfd, selectors.EVENT_READ)
+    buffers = {process.stdout.fileno(): b"", process.stderr.fileno(): b""}
+
+    # Once the process has terminated, we only drain what is left in the pipes
+    # instead of waiting for an EOF that any leftover grandchild could delay.
+    timeout = None
+    with selector:
+        while buffers:
+            events = selector.select(timeout)
+            if not events:
+                break
+            for key, _mask in events:
+                if key.fd == pidfd:
+                    selector.unregister(pidfd)
+                    timeout = 0
+                    continue
+                chunk = os.read(key.fd, 4096)
+                if chunk:
+                    *lines, buffers[key.fd] = (buffers[key.fd] + chunk).split(b"\n")
+                else:
+                    selector.unregister(key.fd)
+                    lines = [buffers.pop(key.fd)]
+                _log_lines(command_logger, *key.data, lines)
+        for key in selector.get_map().values():
+            if key.fd in buffers:
+                _log_lines(command_logger, *key.data, [buffers[key.fd]])
+
+    return stderr_lines
+
+
+def _log_lines(
+    command_logger: logging.Logger,
+    level: int,
+    logged_lines: list[str] | None,
+    lines: list[bytes],
+):
+    for line in lines:
+        if line.strip():
+            decoded_line = line.decode(errors="replace").rstrip()
+            command_logger.log(level, "%s", decoded_line)
+            if logged_lines is not None:
+                logged_lines.append(decoded_line)
+
+
 def setup_logging(
     *, log_config: str | os.PathLike | None = None, level: int = logging.INFO
 ):
     if log_config:
+        import json
+        from logging.config import dictConfig, fileConfig
+
         log_config_path = Path(log_config).expanduser().resolve()
         if log_config_path.suffix == ".json":
-            logging.config.dictConfig(json.loads(log_config_path.read_text()))
+            dictConfig(json.loads(log_config_path.read_text()))
             logger.debug(
                 'Log config was loaded from "%s" via dictConfig.', log_config_path
             )
         else:
-            logging.config.fileConfig(str(log_config_path))
+            fileConfig(str(log_config_path))
             logger.debug(
                 'Log config was loaded from "%s" via fileConfig.', log_config_path
             )
         return
 
+    # basicConfig does nothing if logging is already set up, e.g. by an application
+    # calling cli or by an earlier call of cli. So the level is (also) applied to our
+    # own logger, whose children like pipx-installer.pip inherit it.
     logging.basicConfig(level=level)
+    logger.setLevel(level)
     logger.debug("Logging level was set to %s.", logging.getLevelName(level))
 
 
 def main():
-    cli(**vars(parser.parse_args()))
+    cli(**vars(build_parser().parse_args()))
 
 
 if __name__ == "__main__":
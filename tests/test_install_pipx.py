@@ -0,0 +1,208 @@
+import contextlib
+import importlib.util
+import logging
+import os
+import signal
+import subprocess
+import sys
+import time
+import venv
+
+import pip
+import pytest
+
+import install_pipx
+from install_pipx import cli, run_command, setup_logging
+
+
+def run_python(code: str):
+    run_command([sys.executable, "-c", code], name="python")
+
+
+def test_run_command_logs_stdout_as_info_and_stderr_as_warning(caplog):
+    caplog.set_level(logging.DEBUG)
+    run_python("import sys; print('out'); print('err', file=sys.stderr)")
+    assert (logging.INFO, "out") in [(r.levelno, r.message) for r in caplog.records]
+    assert (logging.WARNING, "err") in [(r.levelno, r.message) for r in caplog.records]
+
+
+def test_run_command_logs_to_named_child_logger(caplog):
+    caplog.set_level(logging.DEBUG)
+    run_python("print('out')")
+    assert [r.name for r in caplog.records] == ["pipx-installer.python"]
+
+
+def test_run_command_logs_trailing_partial_line(caplog):
+    caplog.set_level(logging.DEBUG)
+    run_python("import sys; sys.stdout.write('first\\npartial')")
+    assert [r.message for r in caplog.records] == ["first", "partial"]
+
+
+def test_run_command_raises_on_nonzero_exit(caplog):
+    caplog.set_level(logging.DEBUG)
+    with pytest.raises(subprocess.CalledProcessError) as exc_info:
+        run_python("import sys; print('reason', file=sys.stderr); sys.exit(3)")
+    assert exc_info.value.returncode == 3
+    assert exc_info.value.stderr == "reason"
+
+
+def test_run_command_logs_stderr_of_failure_as_error(caplog):
+    caplog.set_level(logging.ERROR)
+    with pytest.raises(subprocess.CalledProcessError):
+        run_python("import sys; print('reason', file=sys.stderr); sys.exit(1)")
+    assert [(r.levelno, r.message) for r in caplog.records] == [
+        (logging.ERROR, "reason")
+    ]
+
+
+@pytest.mark.skipif(not hasattr(os, "pidfd_open"), reason="requires pidfd_open")
+def test_run_command_does_not_wait_for_grandchildren(caplog):
+    caplog.set_level(logging.DEBUG)
+    start = time.monotonic()
+    try:
+        run_python(
+            "import subprocess, sys; "
+            "grandchild = subprocess.Popen("
+            "[sys.executable, '-c', 'import time; time.sleep(10)']); "
+            "print(grandchild.pid)"
+        )
+        assert time.monotonic() - start < 5
+    finally:
+        for record in caplog.records:
+            with contextlib.suppress(ProcessLookupError):
+                os.kill(int(record.message), signal.SIGKILL)
+
+
+def test_setup_logging_applies_level_when_called_again(monkeypatch):
+    monkeypatch.setattr(logging.root, "handlers", [logging.NullHandler()])
+    root_level = logging.root.level
+    logging.root.setLevel(logging.WARNING)
+    try:
+        setup_logging(level=logging.INFO)
+        setup_logging(level=logging.DEBUG)
+        assert logging.root.level == logging.WARNING
+        assert install_pipx.logger.level == logging.DEBUG
+    finally:
+        logging.root.setLevel(root_level)
+        install_pipx.logger.setLevel(logging.NOTSET)
+
+
+class FakeEnvBuilder:
+    def __init__(self, **kwargs):
+        self.kwargs = kwargs
+
+    def create(self, env_dir):
+        pass
+
+
+@pytest.fixture
+def env_builders(monkeypatch):
+    env_builders = []
+
+    def env_builder(**kwargs):
+        env_builders.append(FakeEnvBuilder(**kwargs))
+        return env_builders[-1]
+
+    monkeypatch.setattr(venv, "EnvBuilder", env_builder)
+    return env_builders
+
+
+@pytest.fixture
+def commands(monkeypatch, env_builders):
+    commands = []
+    monkeypatch.setattr(
+        install_pipx,
+        "run_command",
+        lambda args, *, name, env=None: commands.append((args, name, env)),
+    )
+    for name in ("PIP_DISABLE_PIP_VERSION_CHECK", "PIP_NO_INPUT"):
+        monkeypatch.delenv(name, raising=False)
+    yield commands
+    # cli sets the level of the package logger
+    install_pipx.logger.setLevel(logging.NOTSET)
+
+
+def run_cli(tmp_path, **kwargs):
+    options = {
+        "env_dir": str(tmp_path / "venv"),
+        "system_site_packages": False,
+        "clear": False,
+        "symlinks": True,
+        "prompt": None,
+        "with_pip": True,
+        "upgrade_deps": False,
+        "ensure_path": False,
+        "dry_run": False,
+        "log_config": None,
+        "verbose": 0,
+        "quiet": 0,
+    }
+    cli(**{**options, **kwargs})
+    return tmp_path.resolve() / "venv" / "bin"
+
+
+def test_cli_installs_pipx_with_pip_of_environment(tmp_path, env_builders, commands):
+    bin_dir = run_cli(tmp_path)
+    assert env_builders[0].kwargs["with_pip"] is True
+    [(args, name, env)] = commands
+    assert args == [str(bin_dir / "pip"), "install", "pipx"]
+    assert name == "pip"
+    assert env["PIP_DISABLE_PIP_VERSION_CHECK"] == "1"
+    assert env["PIP_NO_INPUT"] == "1"
+
+
+def test_cli_upgrades_core_deps_in_same_pip_call(tmp_path, commands):
+    bin_dir = run_cli(tmp_path, upgrade_deps=True)
+    [(args, _name, _env)] = commands
+    assert args == [
+        str(bin_dir / "pip"),
+        "install",
+        "--upgrade",
+        "pip",
+        "setuptools",
+        "pipx",
+    ]
+
+
+def test_cli_pip_env_is_overridden_by_environment(tmp_path, commands, monkeypatch):
+    monkeypatch.setenv("PIP_NO_INPUT", "0")
+    run_cli(tmp_path)
+    [(_args, _name, env)] = commands
+    assert env["PIP_NO_INPUT"] == "0"
+    assert env["PIP_DISABLE_PIP_VERSION_CHECK"] == "1"
+
+
+def test_cli_without_pip_installs_pipx_with_host_pip(tmp_path, env_builders, commands):
+    bin_dir = run_cli(tmp_path, with_pip=False)
+    assert env_builders[0].kwargs["with_pip"] is False
+    [(args, name, _env)] = commands
+    assert args == [
+        sys.executable,
+        "-m",
+        "pip",
+        "--python",
+        str(bin_dir / "python"),
+        "install",
+        "pipx",
+    ]
+    assert name == "pip"
+
+
+def test_cli_without_pip_fails_early_without_host_pip(
+    tmp_path, env_builders, commands, monkeypatch
+):
+    monkeypatch.setattr(importlib.util, "find_spec", lambda name: None)
+    with pytest.raises(SystemExit, match="requires pip"):
+        run_cli(tmp_path, with_pip=False)
+    assert env_builders == []
+    assert commands == []
+
+
+def test_cli_without_pip_fails_early_with_old_host_pip(
+    tmp_path, env_builders, commands, monkeypatch
+):
+    monkeypatch.setattr(pip, "__version__", "22.2.2")
+    with pytest.raises(SystemExit, match=r"22\.3 or later"):
+        run_cli(tmp_path, with_pip=False)
+    assert env_builders == []
+    assert commands == []